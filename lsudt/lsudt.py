@@ -7,25 +7,48 @@ import os
 import re
 import pathlib
 import sys
-import bisect
 import errno
+import functools
 import time
 import pyudev
 import yaml
 
+# Prefer the libyaml based loader where PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 class USBDevice:
     """
     Representation of a USB device with links to its parent and children
     """
 
+    __slots__ = (
+        "port_path",
+        "port",
+        "id_vendor_str",
+        "id_product_str",
+        "device_class",
+        "devices",
+        "children",
+        "parent",
+        "label",
+    )
+
     def __init__(self, port_path):
-        self.port_path = port_path
-        self.id_vendor = None
-        self.id_product = None
+        # Port paths are used heavily as dictionary keys, so intern them
+        self.port_path = sys.intern(port_path)
+        # Port number on the parent hub, e.g. 3 for 1-10.3
+        self.port = port_path.rsplit(".", 1)[-1]
+        # Vendor and product IDs as lowercase hex without leading zeros
+        self.id_vendor_str = None
+        self.id_product_str = None
         self.device_class = None
         self.devices = []
         self.children = []
         self.parent = None
+        self.label = None
 
 
 class LinuxDevice:
@@ -33,6 +56,8 @@ class LinuxDevice:
     Representation of a Linux device
     """
 
+    __slots__ = ("devname", "devlinks", "id_path", "eth")
+
     def __init__(self):
         self.devname = None
         self.devlinks = None
@@ -42,124 +67,156 @@ class LinuxDevice:
 
 def populate_usb_info(device: pyudev.Device, usb_device: USBDevice) -> None:
     """
-    Obtains information about a USB device based on device path and populates
-    a given USBDevice object, this approach appears quicker than using pyusb
+    Obtains information about a USB device based on its udev properties and
+    populates a given USBDevice object, this approach appears quicker than
+    using pyusb
     """
 
     # Ensure this is a USB device
-    if "DEVTYPE" not in device or dict(device.properties)["DEVTYPE"] != "usb_device":
+    if device.device_type != "usb_device":
         return
 
-    # Read from sysfs
-    product_path = device.sys_path + "/idProduct"
-    vendor_path = device.sys_path + "/idVendor"
-    device_class_path = device.sys_path + "/bDeviceClass"
-    if (
-        not os.path.isfile(product_path)
-        or not os.path.isfile(vendor_path)
-        or not os.path.isfile(device_class_path)
-    ):
+    # The kernel reports the IDs (in hex) and class (in decimal) of a USB
+    # device in its PRODUCT (idVendor/idProduct/bcdDevice) and TYPE
+    # (bDeviceClass/bDeviceSubClass/bDeviceProtocol) properties, udev has
+    # already read these so there is no need to read them from sysfs
+    properties = device.properties
+    product = properties.get("PRODUCT")
+    device_type = properties.get("TYPE")
+    if product is None or device_type is None:
         return
-    with open(product_path, "r") as file:
-        product_str = file.readline().rstrip()
-    with open(vendor_path, "r") as file:
-        vendor_str = file.readline().rstrip()
-    with open(device_class_path, "r") as file:
-        device_class_str = file.readline().rstrip()
+    vendor_str, product_str = product.split("/")[:2]
+    device_class_str = device_type.split("/")[0]
 
-    # Wrap in a USBInfo object
-    usb_device.id_product = int(product_str, base=16)
-    usb_device.id_vendor = int(vendor_str, base=16)
-    usb_device.device_class = int(device_class_str, base=16)
+    # Wrap in a USBInfo object, the IDs are only ever displayed and PRODUCT
+    # already formats them as we show them so keep them as strings
+    usb_device.id_product_str = product_str
+    usb_device.id_vendor_str = vendor_str
+    usb_device.device_class = int(device_class_str)
 
 
+@functools.lru_cache(maxsize=4096)
 def get_port_path_from_device_path(devpath: str) -> str:
     """
     Returns a USB topology port path (e.g. 1-10.3) from a udev device path (e.g.
     /devices/pci0000:00/0000:00:14.0/usb1/1-10/1-10.3/1-10.3:1.0/ttyUSB0/tty/ttyUSB0)
     """
 
+    # Most devices outside of a USB tree can be ruled out without a regex
+    if "/usb" not in devpath:
+        return None
+
     # Search for the root USB string (e.g. usb1/1-10) and capture the
     # bus number and first port
-    ree = re.search("/usb[0-9]+/([0-9]+-[0-9+])", devpath)
+    ree = USB_ROOT_RE.search(devpath)
     if ree is None:
         return None
 
-    # Work up the path until we reach the USB tree, this will contain the
-    # full USB path in one string, e.g. 1-10.3:1.0
-    ports = devpath.split("/")
-    for portpath in reversed(ports):
-        if portpath.startswith(ree.group(1)):
-            # We only care about the physical topology so lets drop everything
-            # after the colon (e.g. the device config and interface)
-            return portpath.split(":")[0]
+    # Find the deepest path component starting with the root port, this will
+    # contain the full USB path in one string, e.g. 1-10.3:1.0
+    start = devpath.rfind("/" + ree.group(1)) + 1
+    end = devpath.find("/", start)
+    portpath = devpath[start:] if end == -1 else devpath[start:end]
 
-    return None
+    # We only care about the physical topology so lets drop everything
+    # after the colon (e.g. the device config and interface)
+    return sys.intern(portpath.partition(":")[0])
 
 
 def find_usb_device(port_path: str) -> USBDevice:
     """
     Given a port_path find the associated USB device
     """
-    for usb_device in usb_devices_list:
-        if usb_device.port_path == port_path:
-            return usb_device
-    return None
+    return usb_devices_by_port.get(port_path)
 
 
 def add_usb_device(port_path: str, args) -> USBDevice:
     """
-    Create, if needed, a USBDevice for the given port path and add to
-    the existing USB tree. It will also create parent USBDevice's up
-    to the root of the tree.
+    Create a USBDevice for the given port path and add it to the existing
+    USB tree. The parent USBDevice, if any, must already have been added.
     """
 
-    # If device already exists, let's return that
-    usb_device = find_usb_device(port_path)
-    if usb_device is not None:
-        return usb_device
-
     # Create a new USB device and add it to the list
     usb_device = USBDevice(port_path)
     usb_devices_list.append(usb_device)
+    usb_devices_by_port[usb_device.port_path] = usb_device
 
     # If we're filting by port path and we reach the given port path
     # then don't go any further up the tree
     if args.port_path is not None and port_path == args.port_path:
+        usb_roots.append(usb_device)
         return usb_device
 
     # Identify the parent of this device, e.g. 1-10.3.2's parent will be 1-10.3
     usb_tree = port_path.rsplit(".", 1)
     parent_port_path = usb_tree[0]
 
-    # If there is a parent, then find or create it and create a parent/client
+    # If there is a parent, then find it and create a parent/client
     # relationship
     if len(usb_tree) == 2:
         parent = find_usb_device(parent_port_path)
-        if parent is None:
-            parent = add_usb_device(parent_port_path, args)
 
         # Let them know they have each other
         parent.children.append(usb_device)
         usb_device.parent = parent
+    else:
+        usb_roots.append(usb_device)
 
     return usb_device
 
 
+def add_port_path(port_path: str, port_paths: dict, args) -> None:
+    """
+    Record the given port path, along with those of its parents up to the
+    root of the tree, in the ordered set of port paths to create
+    """
+
+    while port_path not in port_paths:
+        port_paths[port_path] = None
+
+        # If we're filting by port path and we reach the given port path
+        # then don't go any further up the tree
+        if args.port_path is not None and port_path == args.port_path:
+            return
+
+        usb_tree = port_path.rsplit(".", 1)
+        if len(usb_tree) != 2:
+            return
+        port_path = usb_tree[0]
+
+
 def does_id_path_match(id_path: str, usb_device: USBDevice) -> bool:
     """
     Determine if the current device or any of its parents have a device path
     that matches the provided root
     """
 
-    for linux_device in usb_device.devices:
-        if linux_device.id_path is not None and linux_device.id_path.startswith(
-            id_path
-        ):
-            return True
-    if usb_device.parent is None:
-        return False
-    return does_id_path_match(id_path, usb_device.parent)
+    # Walk up the tree until we find a match or reach a device we've
+    # already checked, remembering the devices visited along the way
+    visited = []
+    match = False
+    while usb_device is not None:
+        key = (id_path, usb_device.port_path)
+        cached = id_path_matches.get(key)
+        if cached is not None:
+            match = cached
+            break
+
+        visited.append(key)
+        for linux_device in usb_device.devices:
+            device_id_path = linux_device.id_path
+            if device_id_path is not None and device_id_path.startswith(id_path):
+                match = True
+                break
+        if match:
+            break
+        usb_device = usb_device.parent
+
+    # The result applies to every device we passed through on the way up
+    for key in visited:
+        id_path_matches[key] = match
+
+    return match
 
 
 def sanitise_device_path(device_path: str) -> str:
@@ -187,19 +244,14 @@ def populate_device_info(linux_device: pyudev.Device) -> LinuxDevice:
     udev device
     """
     device = LinuxDevice()
+    properties = linux_device.properties
 
-    if "DEVNAME" in linux_device:
-        device.devname = dict(linux_device.properties)["DEVNAME"]
-    if "DEVLINKS" in linux_device:
-        device.devlinks = dict(linux_device.properties)["DEVLINKS"]
-    if "ID_PATH" in linux_device:
-        device.id_path = dict(linux_device.properties)["ID_PATH"]
+    device.devname = linux_device.device_node
+    device.devlinks = properties.get("DEVLINKS")
+    device.id_path = properties.get("ID_PATH")
 
-    if (
-        "SUBSYSTEM" in linux_device
-        and dict(linux_device.properties)["SUBSYSTEM"] == "net"
-    ):
-        device.eth = dict(linux_device.properties)["INTERFACE"]
+    if linux_device.subsystem == "net":
+        device.eth = properties.get("INTERFACE")
 
     # Only return the device if it has something we can display
     if device.devname is None and device.eth is None:
@@ -208,7 +260,37 @@ def populate_device_info(linux_device: pyudev.Device) -> LinuxDevice:
     return device
 
 
-def scan_usb_tree(args) -> None:
+def list_usb_tree_devices(context: pyudev.Context, root_device_path: str, args):
+    """
+    Enumerate the udev devices found beneath each USB root hub, or beneath
+    the given device path, this avoids iterating over every device on the
+    system
+    """
+
+    # If we are filtering by device path, and it names a device, then only
+    # enumerate the devices beneath it. Otherwise the path is checked against
+    # each device as it is scanned.
+    if root_device_path != "/":
+        try:
+            root_device = pyudev.Devices.from_path(context, root_device_path)
+        except pyudev.DeviceNotFoundError:
+            root_device = None
+
+        if root_device is not None:
+            yield from context.list_devices(parent=root_device, tag=args.tag)
+            return
+
+    root_hubs = context.list_devices(subsystem="usb", DEVTYPE="usb_device")
+    for root_hub in root_hubs:
+        # Root hubs are named after their bus (e.g. usb1) whereas other USB
+        # devices are named after their port path (e.g. 1-10.3)
+        if not root_hub.sys_name.startswith("usb"):
+            continue
+
+        yield from context.list_devices(parent=root_hub, tag=args.tag)
+
+
+def scan_usb_tree(context: pyudev.Context, args) -> None:
     """
     Enumerate devices from udev and construct a USB tree
     """
@@ -218,12 +300,16 @@ def scan_usb_tree(args) -> None:
     if args.device_path is not None:
         root_device_path = sanitise_device_path(args.device_path)
 
-    # Get all the devices from udev
-    context = pyudev.Context()
-    linux_devices = context.list_devices(tag=args.tag)
+    # Get the devices from udev which are part of a USB tree
+    linux_devices = list_usb_tree_devices(context, root_device_path, args)
+
+    # Port paths of the USB devices to create, in the order they were found
+    # (a dict is used as an ordered set)
+    port_paths = {}
+    found_devices = []
 
     for linux_device in linux_devices:
-        devpath = dict(linux_device.properties)["DEVPATH"]
+        devpath = linux_device.device_path
 
         # If we are filtering by device path, ignore anything outside of filter
         if not devpath.startswith(root_device_path):
@@ -239,9 +325,18 @@ def scan_usb_tree(args) -> None:
         if args.port_path is not None and not port_path.startswith(args.port_path):
             continue
 
-        # We have a device with a port path so let's represent this as a USB
-        # device
-        usb_device = add_usb_device(port_path, args)
+        found_devices.append((port_path, linux_device))
+        add_port_path(port_path, port_paths, args)
+
+    # We have devices with port paths so let's represent these as USB devices,
+    # creating them shallowest first so that each parent exists before its
+    # children are added
+    for port_path in sorted(port_paths, key=lambda path: path.count(".")):
+        add_usb_device(port_path, args)
+
+    usb_devices = usb_devices_by_port
+    for port_path, linux_device in found_devices:
+        usb_device = usb_devices[port_path]
 
         # Obtain USB device information, even though the udev device is on the
         # USB bus, this particular devpath may not be a usb device (e.g. could
@@ -252,13 +347,11 @@ def scan_usb_tree(args) -> None:
         if linux_device:
             usb_device.devices.append(linux_device)
 
-
-def showtree(usb_devices, space, args) -> None:
-    """
-    Display the USB tree for the given list of USB devices
-    """
-    for usb_device in usb_devices:
-        show(usb_device, space, args)
+            # Index the port paths by the ID_PATHs of their devices
+            if linux_device.id_path is not None:
+                ports = id_path_ports.setdefault(linux_device.id_path, [])
+                if usb_device.port_path not in ports:
+                    ports.append(usb_device.port_path)
 
 
 def parse_one_configuration_file(path: str):
@@ -266,8 +359,8 @@ def parse_one_configuration_file(path: str):
     Read a yml config files and obtain segments and mappings
     """
     try:
-        with open(path, "r") as config_file:
-            i = yaml.safe_load(config_file)
+        with open(path, "rb") as config_file:
+            i = yaml.load(config_file, Loader=SafeLoader)
             if i is None:
                 return
             if i.get("mappings"):
@@ -299,9 +392,10 @@ def read_configuration():
     if not os.path.isdir(settings_path):
         return
 
-    for config in os.listdir(settings_path):
-        if config.endswith(".yml"):
-            parse_one_configuration_file(f"{settings_path}/{config}")
+    with os.scandir(settings_path) as entries:
+        for entry in entries:
+            if entry.name.endswith(".yml") and entry.is_file():
+                parse_one_configuration_file(entry.path)
 
 
 def determine_root_ports_from_id_path(id_path: str):
@@ -309,13 +403,7 @@ def determine_root_ports_from_id_path(id_path: str):
     Given an id_path (e.g. pci-0000:00:14.0-usb-0:5) get the current
     port numbers (e.g. 1-5, 2-5) associated with it
     """
-    ports = []
-    for usb_device in usb_devices_list:
-        for linux_device in usb_device.devices:
-            if linux_device.id_path is not None and linux_device.id_path == id_path:
-                ports.append(usb_device.port_path)
-
-    return ports
+    return id_path_ports.get(id_path, [])
 
 
 def load_port_labels():
@@ -346,13 +434,47 @@ def load_port_labels():
             # Add port labels and envs for the ports
             for port in segment["ports"]:
                 if port.get("port") is not None and port.get("label") is not None:
-                    full_port_path = f"{port_path}.{port['port']}"
+                    full_port_path = sys.intern(f"{port_path}.{port['port']}")
                     port_labels[full_port_path] = {}
                     if port.get("label") is not None:
                         port_labels[full_port_path]["label"] = port["label"]
                     if port.get("env") is not None:
                         port_labels[full_port_path]["env"] = port["env"]
 
+    # Index the labels by each port path leading up to them (e.g. 1-10,
+    # 1-10.2 and 1-10.2.3 for 1-10.2.3) so the labels at or below a port can
+    # be found without scanning them all
+    for path, label in port_labels.items():
+        ports = path.split(".")
+        for i in range(1, len(ports) + 1):
+            port_labels_by_prefix.setdefault(".".join(ports[:i]), []).append(label)
+
+    # Attach the label to display for each USB device
+    for usb_device in usb_devices_list:
+        label = port_labels.get(usb_device.port_path)
+        if isinstance(label, dict):
+            label = label["label"]
+        usb_device.label = label
+
+def resolve_mapping_roots():
+    """
+    Resolve the root of each mapping to a port path, so that the devices of a
+    port can be associated with their mapping identifier
+    """
+    for id in mappings:
+        if "port" in mappings[id]:
+            accessor = "port"
+        elif "idpath" in mappings[id]:
+            accessor = "idpath"
+
+        to_compare = mappings[id][accessor]
+        root_ports = determine_root_ports_from_id_path(to_compare)
+        if len(root_ports) > 0:
+            to_compare = root_ports[0]
+
+        # The first mapping for a given root wins
+        mapping_roots.setdefault(to_compare, id)
+
 def check_args_for_print(usb_device, args) -> bool:
     """
     Checks args and acts accordingly for borwsing
@@ -368,17 +490,6 @@ def check_args_for_print(usb_device, args) -> bool:
         if not does_id_path_match(args.id_path, usb_device):
             return True
 
-def add_uniq(list_in : list, new_val):
-    """
-    adds a value to the provided list but only
-    if it isn't already present
-    """
-    if new_val in list_in:
-        return list_in
-
-    bisect.insort(list_in, new_val)
-    return list_in
-
 def filter(device, args) -> str:
     """
     Filter out /dev/bus/usb devices if needed
@@ -394,38 +505,32 @@ def filter(device, args) -> str:
     return devname
 
 
-def print_port(usb_device, space):
+def print_port(usb_device, space, out):
     """
     prints port information i.e.
         Port 3-2: hub used for things (1a40:101 / 3-2)
     """
-    # Determine the port number from the port path
-    ports = usb_device.port_path.rsplit(".", 1)
-    port = next(reversed(ports))
+    port = usb_device.port
     # Create labels
     device_type = "Hub" if usb_device.device_class == 9 else "Device"
 
     # Display device info
-    if usb_device.port_path in port_labels:
-        if port_labels.get(usb_device.port_path):
-            if type(port_labels[usb_device.port_path]) is str:
-                device_type = port_labels[usb_device.port_path]
-            else:
-                device_type = port_labels[usb_device.port_path]['label']
+    if usb_device.label:
+        device_type = usb_device.label
     usb_info = (
         ""
-        if usb_device.id_vendor is None
-        else f"{usb_device.id_vendor:x}:{usb_device.id_product:x}"
+        if usb_device.id_vendor_str is None
+        else f"{usb_device.id_vendor_str}:{usb_device.id_product_str}"
     )
-    if usb_device.id_vendor is not None:
-        print(
-            f"{space}Port {port}: {device_type} ({usb_info} / {usb_device.port_path})"
+    if usb_device.id_vendor_str is not None:
+        out.append(
+            f"{space}Port {port}: {device_type} ({usb_info} / {usb_device.port_path})\n"
         )
     else:
-        print(f"{space}Port {port}: ({usb_device.port_path})")
+        out.append(f"{space}Port {port}: ({usb_device.port_path})\n")
 
 
-def print_devices_of_port(device, devname, args, space) -> bool:
+def print_devices_of_port(device, devname, args, space, out) -> bool:
     """
     prints sub port information, i.e.
             Port 2: things foo (403:6001 / 3-2.2)
@@ -436,104 +541,118 @@ def print_devices_of_port(device, devname, args, space) -> bool:
         if device.id_path is None or args.show_idpath is False
         else f" ({device.id_path})"
     )
-    print(f"{space}   {devname}{id_path}")
+    out.append(f"{space}   {devname}{id_path}\n")
     if args.show_device_links:
         if device.devlinks is not None:
             device_links = device.devlinks.split(" ")
             for link in device_links:
-                print(f"{space}   : {link}")
-            print("")
+                out.append(f"{space}   : {link}\n")
+            out.append("\n")
             space_added = True
     return space_added
 
 def determine_device_from_port_path(port_path : str):
-    for id in mappings:
-        if "port" in mappings[id]:
-            accessor = "port"
-        elif "idpath" in mappings[id]:
-            accessor = "idpath"
-
-        to_compare = mappings[id][accessor]
-        root_ports = determine_root_ports_from_id_path(to_compare)
-        if len(root_ports) > 0:
-           to_compare =  root_ports[0]
-
-        if to_compare in port_path:
+    # Walk up the tree from the given port until we reach the root of a mapping
+    while True:
+        id = mapping_roots.get(port_path)
+        if id is not None:
             return id
 
+        usb_tree = port_path.rsplit(".", 1)
+        if len(usb_tree) != 2:
+            return None
+        port_path = usb_tree[0]
+
 def determine_env_name_and_options(port_path : str):
-    for path in port_labels:
-        if port_path in path:
-            if "env" in port_labels[path]:
-                env = port_labels[path]["env"].split(',')
-                if len(env) == 2:
-                    return env[0],env[1]
-                else:
-                    return env[0],""
+    for label in port_labels_by_prefix.get(port_path, []):
+        if isinstance(label, dict) and "env" in label:
+            env = label["env"].split(',')
+            if len(env) == 2:
+                return env[0],env[1]
+            else:
+                return env[0],""
 
     return None,None
 
+def determine_port_env(port_path : str):
+    """
+    Determine the mapping identifier, env name and options for a port path,
+    remembering the result as every device of the port asks for the same
+    """
+    port_env = port_envs.get(port_path)
+    if port_env is None:
+        identifier = determine_device_from_port_path(port_path=port_path)
+        env,options = determine_env_name_and_options(port_path=port_path)
+        port_env = (identifier, env, options)
+        port_envs[port_path] = port_env
+
+    return port_env
+
 def build_env_dict(devname, port_path):
     """
     This function builds env_dict for printing
     """
     global envs_dict
-    env = None
-    options = ""
-    identifier = ""
-    env_path = port_path
 
-    identifier = determine_device_from_port_path(port_path=port_path)
-    env,options = determine_env_name_and_options(port_path=port_path)
+    identifier, env, options = determine_port_env(port_path)
 
     if env is None:
         return
 
     if devname is not None:
-        if not envs_dict.get(identifier):
-            envs_dict[identifier] = {env : list()}
-        if not envs_dict[identifier].get(env):
-            envs_dict[identifier][env] = list()
+        devices = envs_dict.setdefault(identifier, {}).setdefault(env, set())
 
         # Check for device prefix
         if options != "":
             basename = devname.split('/')[-1]
             if basename[0:len(options)] == options:
-                envs_dict[identifier][env] = add_uniq(envs_dict[identifier][env], devname)
+                devices.add(devname)
         else:
-            envs_dict[identifier][env] = add_uniq(envs_dict[identifier][env], devname)
+            devices.add(devname)
 
-def show(usb_device, space, args) -> None:
+def show(usb_device, space, args, out) -> None:
     """
-    Display the USB tree for the given USB device
+    Display the USB tree for the given USB device, appending lines of output
+    to the given list
     """
 
-    if check_args_for_print(usb_device, args):
-        return
+    # Walk the tree depth first with our own stack rather than recursing
+    stack = [(usb_device, space)]
+    while stack:
+        usb_device, space = stack.pop()
 
-    if not args.extract_env:
-        print_port(usb_device, space)
-
-    space_added = False
-    # Iterate through the devices associated with this USB device
-    for device in usb_device.devices:
-        devname = filter(device, args)
-        if len(devname) == 0:
+        # Skipping a device also skips everything below it
+        if check_args_for_print(usb_device, args):
             continue
 
         if not args.extract_env:
-            space_added = print_devices_of_port(device, devname, args, space)
-        else:
-            if f"{usb_device.port_path}.0" in port_labels:
-                build_env_dict(devname, f"{usb_device.port_path}.0")
+            print_port(usb_device, space, out)
+
+        # The devices of a port may be labelled through a sub-port of 0
+        env_port_path = usb_device.port_path
+        if args.extract_env and f"{env_port_path}.0" in port_labels:
+            env_port_path = f"{env_port_path}.0"
+
+        space_added = False
+        # Iterate through the devices associated with this USB device
+        for device in usb_device.devices:
+            devname = filter(device, args)
+            if len(devname) == 0:
+                continue
+
+            if not args.extract_env:
+                space_added = print_devices_of_port(device, devname, args, space, out)
             else:
-                build_env_dict(devname, usb_device.port_path)
+                build_env_dict(devname, env_port_path)
 
-    if len(usb_device.children) != 0:
-        showtree(usb_device.children, space + "    ", args)
-    elif space_added is False:
-        if not args.extract_env:
-            print("")
+        if len(usb_device.children) != 0:
+            # Push in reverse so the children are shown in order
+            child_space = space + "    "
+            for child in reversed(usb_device.children):
+                stack.append((child, child_space))
+        elif space_added is False:
+            if not args.extract_env:
+                out.append("\n")
 
 
 def init_argparse() -> argparse.ArgumentParser:
@@ -659,8 +778,8 @@ def generate_env_strings() -> list:
             continue
         for env in envs_dict[id]:
                 counter = 0
-                for dev in envs_dict[id][env]:
-                    env_strings.append(f"{label}_{env}_{counter}={dev} ")
+                for dev in sorted(envs_dict[id][env]):
+                    env_strings.append(f"{label}_{env}_{counter}={dev}")
                     counter+=1
 
 
@@ -670,51 +789,121 @@ def are_nodes_missing(envs_to_check : list, env_strings : list) -> bool:
     variable is present
     """
 
-    # we only care about the envs name
-    stripped_envs = []
+    needed = set(envs_to_check)
     for e_s in env_strings:
-        stripped = e_s.split("=")[0]
-        stripped_envs.append(stripped)
+        # we only care about the envs name
+        needed.discard(e_s.split("=", 1)[0])
+        if not needed:
+            # all of the requested envs are present
+            return False
 
-    if all(i in stripped_envs for i in envs_to_check):
-        # all of the requested envs are present
-        return False
-    else:
-        # we're missing one or more
-        return True
+    # we're missing one or more
+    return bool(needed)
 
 
-def wait_for_env(args : argparse):
+def rescan_for_env(context : pyudev.Context, args : argparse, wait_list : list) -> bool:
     """
-    specifically handles wait_for_env by continuously running the script
-    until it sees the required environment variable appear
+    Rescan the USB tree and check if any of the environment variables
+    we are waiting for are still missing
     """
-    global env_strings
+    # The configuration doesn't change between scans, so only start over
+    # with the state derived from the scan
+    init_scan_globals()
+    scan_read_and_associate_devices_with_configs(context, args)
+    return are_nodes_missing(wait_list, env_strings)
 
+
+def wait_for_env(context : pyudev.Context, args : argparse, monitor):
+    """
+    specifically handles wait_for_env by continuously running the script
+    until it sees the required environment variable appear, rescanning when
+    the udev monitor (if we have one) reports a change to a USB device
+    """
     timeout_reached = 0
     wait_list = args.wait_for_env.copy()
     # Set arg so that we don't recurse
     args.wait_for_env = []
 
     ret = are_nodes_missing(wait_list, env_strings)
+    max_timeout = int(args.wait_timeout)
+    deadline = time.monotonic() + max_timeout if max_timeout > -1 else None
+
     while ret:
         # Check we're still within our timeout
-        timeout_reached = handle_timeout(args)
+        if monitor is not None:
+            timeout_reached = wait_for_udev_event(monitor, deadline)
+        else:
+            timeout_reached = handle_timeout(args)
         if timeout_reached != 0:
             break
 
-        init_globals()
-        scan_read_and_associate_devices_with_configs(args)
-        ret = are_nodes_missing(wait_list, env_strings)
+        ret = rescan_for_env(context, args, wait_list)
 
     if timeout_reached == errno.ETIMEDOUT:
         print("Error. Timed out.", file=sys.stderr)
         return errno.ETIMEDOUT
 
 
+def start_udev_monitor(context : pyudev.Context):
+    """
+    Start listening for udev device events, returns None if we are unable
+    to do so. Events are queued from this point on, so this is done before
+    the first scan to avoid missing changes made while scanning.
+    """
+    try:
+        monitor = pyudev.Monitor.from_netlink(context)
+        monitor.start()
+    except OSError:
+        return None
+
+    return monitor
+
+
+def wait_for_udev_event(monitor : pyudev.Monitor, deadline):
+    """
+    Waits for udev to report an event for a USB device, or for a second to
+    pass, whichever comes first. Returns ETIMEDOUT once the deadline (a
+    time.monotonic() time, or None to wait forever) has passed.
+    """
+    now = time.monotonic()
+    if deadline is not None and now >= deadline:
+        return errno.ETIMEDOUT
+
+    # Wake up at least once a second so that we still rescan if events are
+    # never delivered, e.g. when udevd isn't running the monitor opens fine
+    # but stays silent, while new nodes can still be found by scanning
+    wake = now + 1
+    if deadline is not None:
+        wake = min(wake, deadline)
+
+    while True:
+        timeout = wake - time.monotonic()
+        if timeout <= 0:
+            break
+
+        device = monitor.poll(timeout=timeout)
+        if device is None:
+            break
+
+        # Only devices within a USB tree can be displayed, so ignore
+        # everything else (e.g. power_supply or non-USB block changes).
+        # We can't filter on the usb subsystem alone as the nodes we show,
+        # such as ttys and block devices, are added after the USB device.
+        if get_port_path_from_device_path(device.device_path) is not None:
+            # Events tend to arrive in bursts (e.g. a device and its
+            # interfaces), so consume any that are already queued and cover
+            # them with a single rescan, without going past our wake up time
+            while time.monotonic() < wake and monitor.poll(timeout=0) is not None:
+                pass
+            break
+
+    return 0
+
+
 def handle_timeout(args):
     """
-    Checks for timeout
+    Checks for timeout, sleeping for a second between checks, this is used
+    when we can't listen for udev events
     """
     global TIMEOUT_COUNTER
 
@@ -729,18 +918,44 @@ def handle_timeout(args):
     return 0
 
 
+# Matches the root USB string of a device path (e.g. usb1/1-10) capturing
+# the bus number and first port
+USB_ROOT_RE = re.compile(r"/usb[0-9]+/([0-9]+-[0-9]+)")
+
 # Flat list of all USB devices discovered
 usb_devices_list = []
 
+# Index of the USB devices discovered, keyed by port path
+usb_devices_by_port = {}
+
+# USB devices at the top of each USB tree
+usb_roots = []
+
+# Port paths of the USB devices with a device of a given ID_PATH
+id_path_ports = {}
+
+# Results of does_id_path_match keyed by (id_path, port path)
+id_path_matches = {}
+
 # Map between ports and their labels
 port_labels = {}
 
+# Labels of the ports at or below a given port path
+port_labels_by_prefix = {}
+
 # List of 'segment' objects representing a labelled section of USB tree
 segments = []
 
 # Mappings between segments and their port path
 mappings = {}
 
+# Mapping identifiers keyed by the port path (or idpath if not present)
+# they resolve to
+mapping_roots = {}
+
+# Mapping identifier, env name and options keyed by port path
+port_envs = {}
+
 # Environment var name against a set of devices
 envs_dict = {}
 
@@ -754,20 +969,30 @@ WAIT_TIMEOUT_DEFAULT = 10
 TIMEOUT_COUNTER = int(0)
 
 
-def init_globals():
+def init_scan_globals():
     """
-    init globals to be empty
+    init globals derived from a scan of the USB tree to be empty
     """
     global usb_devices_list
+    global usb_devices_by_port
+    global usb_roots
+    global id_path_ports
+    global id_path_matches
     global port_labels
-    global segments
-    global mappings
+    global port_labels_by_prefix
+    global mapping_roots
+    global port_envs
     global envs_dict
 
     usb_devices_list = []
+    usb_devices_by_port = {}
+    usb_roots = []
+    id_path_ports = {}
+    id_path_matches = {}
     port_labels = {}
-    segments = []
-    mappings = {}
+    port_labels_by_prefix = {}
+    mapping_roots = {}
+    port_envs = {}
     envs_dict = {}
 
 
@@ -788,46 +1013,42 @@ def handle_args_path_type(args):
     return args
 
 
-def scan_read_and_associate_devices_with_configs(args) -> list:
+def scan_read_and_associate_devices_with_configs(context: pyudev.Context, args, monitor=None) -> list:
     """
     This function runs the meat of the script and exists to allow
     us to re-run the script if we're waiting for a devnode to come up
     """
     ret = 0
 
-    # Read config
-    read_configuration()
-
-    args = handle_args_path_type(args)
-
     # Scan for devices and construct a tree
-    scan_usb_tree(args)
+    scan_usb_tree(context, args)
 
     # Read port labels from configuration files
     # (This must come after a scan as idpath to port path lookup)
     load_port_labels()
+    resolve_mapping_roots()
+
+    # Collect the output of the tree and write it out in one go
+    out = []
 
     # When filtering by ID path show tree starting with a USB device starting
     # with the ID path
     if args.id_path is not None:
-        for device in usb_devices_list:
-            for linux_device in device.devices:
-                if linux_device.id_path == args.id_path:
-                    show(device, "", args)
+        for port_path in determine_root_ports_from_id_path(args.id_path):
+            show(find_usb_device(port_path), "", args, out)
     # Otherwise display from the top of all known USB trees
     else:
-        for device in usb_devices_list:
+        for device in usb_roots:
+            show(device, "", args, out)
 
-            # Render from roots
-            if device.parent is None:
-                show(device, "", args)
+    sys.stdout.write("".join(out))
 
     if args.extract_env is True or args.wait_for_env is not None:
         if len(envs_dict) > 0:
             generate_env_strings()
         if args.wait_for_env is not None:
             if len(args.wait_for_env) > 0:
-                ret = wait_for_env(args)
+                ret = wait_for_env(context, args, monitor)
 
     return ret
 
@@ -843,13 +1064,28 @@ def main() -> None:
     if args.wait_timeout is None:
         args.wait_timeout = WAIT_TIMEOUT_DEFAULT
 
-    ret = scan_read_and_associate_devices_with_configs(args)
+    # Read config, this is only done once even if we rescan while waiting
+    # for an environment variable
+    read_configuration()
+
+    args = handle_args_path_type(args)
+
+    # The udev context is reused for every scan
+    context = pyudev.Context()
+
+    # When waiting for an environment variable, listen for udev events so
+    # that we rescan as soon as a USB device changes rather than waiting
+    # for the next once a second rescan
+    monitor = None
+    if args.wait_for_env is not None and int(args.wait_timeout) != 0:
+        monitor = start_udev_monitor(context)
+
+    ret = scan_read_and_associate_devices_with_configs(context, args, monitor)
 
     if ret == errno.ETIMEDOUT:
         sys.exit(errno.ETIMEDOUT)
 
-    for e_s in env_strings:
-        print(f"{e_s}", end=" ")
+    sys.stdout.write(" ".join(env_strings))
 
 
 if __name__ == "__main__":